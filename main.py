@@ -1,63 +1,538 @@
-from fastapi import FastAPI, HTTPException
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import functools
+import hashlib
+import json
 import logging
 import os
+import re
+import sys
+import threading
 
-from openai import OpenAI
-from presidio_analyzer import AnalyzerEngine, PatternRecognizer, Pattern
+import faiss
+import httpx
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+try:
+    import hyperscan
+except ImportError:  # Sin wheels para la plataforma (ARM, macOS): se usa `re`
+    hyperscan = None
+
+from openai import AsyncOpenAI
+from presidio_analyzer import (
+    AnalyzerEngine,
+    EntityRecognizer,
+    Pattern,
+    RecognizerResult,
+)
 from presidio_analyzer.nlp_engine import NlpEngineProvider
 from presidio_anonymizer import AnonymizerEngine
+from presidio_anonymizer.entities import OperatorConfig
 
 # --- 1. CONFIGURACIÓN ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("secure-chat-api")
 
+# SPACY_MODEL acepta un paquete instalado o la ruta a un pipeline propio
+# (ej. un NER podado/destilado) sin tocar el código.
+SPACY_MODEL = os.environ.get("SPACY_MODEL", "es_core_news_sm")
 nlp_config = {
     "nlp_engine_name": "spacy",
-    "models": [{"lang_code": "es", "model_name": "es_core_news_sm"}],
+    "models": [{"lang_code": "es", "model_name": SPACY_MODEL}],
 }
-provider = NlpEngineProvider(nlp_configuration=nlp_config)
-analyzer = AnalyzerEngine(nlp_engine=provider.create_engine(), supported_languages=["es"])
+# Para detectar PII Presidio sólo necesita tokens y NER; el resto del pipeline
+# de spaCy (parser, morfología, lemas) es costo por request sin beneficio.
+UNUSED_SPACY_PIPES = ("tagger", "morphologizer", "parser", "senter", "attribute_ruler", "lemmatizer")
 anonymizer = AnonymizerEngine()
 
 # --- 2. REGLAS PERSONALIZADAS (DNI, Plata, etc.) ---
 
+# Presidio compila el regex de cada Pattern dentro de analyze(). Acá se compila
+# una sola vez al importar y las reglas recorren las coincidencias directo.
+REGEX_FLAGS = re.IGNORECASE
+
+class CompiledPattern(Pattern):
+    def __init__(self, name: str, regex: str, score: float):
+        super().__init__(name=name, regex=regex, score=score)
+        self.compiled_regex = re.compile(regex, REGEX_FLAGS)
+        self.compiled_with_flags = REGEX_FLAGS
+
+# Anclas baratas que acotan dónde corren los regex más caros: corridas de dígitos
+# para DNI/teléfono y símbolos o palabras de moneda para montos.
+DIGIT_RUN_REGEX = re.compile(r"\d[\d.\-() ]{5,}\d")
+MONEY_ANCHOR_REGEX = re.compile(r"\$|usd|eur|pesos|dólares", REGEX_FLAGS)
+CANDIDATE_WINDOW = 40
+
+def is_token_char(c: str) -> bool:
+    return c.isalnum() or c in ".,-()+"
+
+@dataclass
+class PatternRule:
+    """Una regla propia: la entidad que marca y sus patrones precompilados."""
+    entity: str
+    patterns: List[CompiledPattern]
+    # Si el texto tiene menos dígitos, ni siquiera se corre el regex
+    min_digits: int = 0
+    # Si se da, los patrones sólo corren cerca de sus anclas
+    candidate_regex: Optional[re.Pattern] = None
+
+    def candidate_windows(self, text: str) -> List[Tuple[int, int]]:
+        if self.candidate_regex is None:
+            return [(0, len(text))]
+
+        # ±CANDIDATE_WINDOW alrededor de cada ancla, estirado hasta el borde del
+        # token: finditer(text, pos, endpos) trata endpos como fin de texto y
+        # un corte a mitad de número cambiaría la coincidencia
+        windows = []
+        for anchor in self.candidate_regex.finditer(text):
+            start = max(anchor.start() - CANDIDATE_WINDOW, 0)
+            end = min(anchor.end() + CANDIDATE_WINDOW, len(text))
+            while start > 0 and is_token_char(text[start - 1]):
+                start -= 1
+            while end < len(text) and is_token_char(text[end]):
+                end += 1
+            if windows and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(end, windows[-1][1]))
+            else:
+                windows.append((start, end))
+        return windows
+
+    def match(
+        self,
+        text: str,
+        windows: List[Tuple[int, int]],
+        owner: EntityRecognizer,
+        patterns: Optional[List[CompiledPattern]] = None,
+    ) -> List[RecognizerResult]:
+        # owner: el recognizer registrado en Presidio al que se atribuyen los resultados
+        # patterns: subconjunto de self.patterns a correr (por defecto, todos)
+        results = []
+        for pattern in self.patterns if patterns is None else patterns:
+            for pos, endpos in windows:
+                for match in pattern.compiled_regex.finditer(text, pos, endpos):
+                    start, end = match.span()
+                    if start == end:
+                        continue
+                    # Sin AnalysisExplanation: se analiza con return_decision_process=False
+                    # y Presidio la descartaría de todos modos
+                    results.append(RecognizerResult(
+                        entity_type=self.entity,
+                        start=start,
+                        end=end,
+                        score=pattern.score,
+                        analysis_explanation=None,
+                        recognition_metadata={
+                            RecognizerResult.RECOGNIZER_NAME_KEY: owner.name,
+                            RecognizerResult.RECOGNIZER_IDENTIFIER_KEY: owner.id,
+                        },
+                    ))
+        return results
+
 # A. EMAIL
-email_pattern = Pattern(name="email_pattern", regex=r"\b[\w\.-]+@[\w\.-]+\.\w{2,4}\b", score=1.0)
-email_recognizer = PatternRecognizer(supported_entity="EMAIL_CUSTOM", patterns=[email_pattern], supported_language="es")
-analyzer.registry.add_recognizer(email_recognizer)
+email_pattern = CompiledPattern(name="email_pattern", regex=r"\b[\w\.-]+@[\w\.-]+\.\w{2,4}\b", score=1.0)
+email_rule = PatternRule(entity="EMAIL_CUSTOM", patterns=[email_pattern])
 
 # B. TELÉFONO
-phone_pattern = Pattern(name="phone_pattern", regex=r"\b(?:\+?\d{1,3}[- ]?)?\(?\d{2,4}\)?[- ]?\d{3,4}[- ]?\d{3,4}\b", score=0.8)
-phone_recognizer = PatternRecognizer(supported_entity="PHONE_CUSTOM", patterns=[phone_pattern], supported_language="es")
-analyzer.registry.add_recognizer(phone_recognizer)
+phone_pattern = CompiledPattern(name="phone_pattern", regex=r"\b(?:\+?\d{1,3}[- ]?)?\(?\d{2,4}\)?[- ]?\d{3,4}[- ]?\d{3,4}\b", score=0.8)
+phone_rule = PatternRule(entity="PHONE_CUSTOM", patterns=[phone_pattern], candidate_regex=DIGIT_RUN_REGEX)
 
 # C. CUENTA BANCARIA
-bank_pattern = Pattern(name="bank_pattern", regex=r"\b[A-Z0-9]{15,30}\b|(?:\d[ -]*?){10,22}", score=0.6)
-bank_recognizer = PatternRecognizer(supported_entity="BANK_ACCOUNT", patterns=[bank_pattern], supported_language="es")
-analyzer.registry.add_recognizer(bank_recognizer)
+# Dos patrones sin cuantificadores anidados (el viejo `(?:\d[ -]*?){10,22}`
+# hacía backtracking catastrófico). Con menos de 10 dígitos no hay cuenta posible.
+bank_code_pattern = CompiledPattern(name="bank_code_pattern", regex=r"\b[A-Z0-9]{15,30}\b", score=0.6)
+bank_digits_pattern = CompiledPattern(name="bank_digits_pattern", regex=r"\b\d(?:[ -]?\d){9,21}\b", score=0.6)
+bank_rule = PatternRule(entity="BANK_ACCOUNT", patterns=[bank_code_pattern, bank_digits_pattern], min_digits=10)
 
 # D. DNI ARGENTINO (NUEVO)
 # Busca números de 7 a 8 dígitos, opcionalmente con puntos de miles
-dni_pattern = Pattern(name="dni_pattern", regex=r"\b\d{1,2}\.?\d{3}\.?\d{3}\b", score=0.85)
-dni_recognizer = PatternRecognizer(supported_entity="DNI_ARG", patterns=[dni_pattern], supported_language="es")
-analyzer.registry.add_recognizer(dni_recognizer)
+dni_pattern = CompiledPattern(name="dni_pattern", regex=r"\b\d{1,2}\.?\d{3}\.?\d{3}\b", score=0.85)
+dni_rule = PatternRule(entity="DNI_ARG", patterns=[dni_pattern], candidate_regex=DIGIT_RUN_REGEX)
 
 # E. DINERO / MONTOS (NUEVO)
 # Busca símbolos $ o palabras 'pesos', 'dólares', 'usd' cerca de números
-money_pattern = Pattern(name="money_pattern", regex=r"(?:\$|USD|EUR)\s?[\d.,]+|[\d.,]+\s?(?:pesos|dólares|usd|eur|us\$)", score=0.8)
-money_recognizer = PatternRecognizer(supported_entity="MONEY_AMOUNT", patterns=[money_pattern], supported_language="es")
-analyzer.registry.add_recognizer(money_recognizer)
+money_pattern = CompiledPattern(name="money_pattern", regex=r"(?:\$|USD|EUR)\s?[\d.,]+|[\d.,]+\s?(?:pesos|dólares|usd|eur|us\$)", score=0.8)
+money_rule = PatternRule(entity="MONEY_AMOUNT", patterns=[money_pattern], candidate_regex=MONEY_ANCHOR_REGEX)
+
+# F. UN SOLO RECOGNIZER PARA TODAS LAS REGLAS
+# Presidio despacha cada recognizer registrado por separado. Registrando uno
+# solo hay un despacho por request, y el conteo de dígitos y las ventanas
+# candidatas (compartidas por DNI y teléfono) se calculan una vez.
+class CombinedPatternRecognizer(EntityRecognizer):
+    def __init__(self, rules: List[PatternRule], name: str = "CombinedPatternRecognizer"):
+        self.rules = rules
+        super().__init__(
+            supported_entities=[rule.entity for rule in rules],
+            name=name,
+            supported_language="es",
+        )
+
+    def load(self) -> None:
+        pass
+
+    def candidate_patterns(self, text: str) -> Optional[Set[str]]:
+        # Nombres de los patrones que pueden coincidir en el texto (None = todos)
+        return None
+
+    def analyze(self, text, entities, nlp_artifacts=None) -> List[RecognizerResult]:
+        digit_count = sum(map(str.isdigit, text))
+        candidates = self.candidate_patterns(text)
+        windows_by_anchor: Dict[Optional[re.Pattern], List[Tuple[int, int]]] = {}
+        results = []
+        for rule in self.rules:
+            if entities and rule.entity not in entities:
+                continue
+            if digit_count < rule.min_digits:
+                continue
+            patterns = rule.patterns
+            if candidates is not None:
+                patterns = [pattern for pattern in patterns if pattern.name in candidates]
+                if not patterns:
+                    continue
+            anchor = rule.candidate_regex
+            if anchor not in windows_by_anchor:
+                windows_by_anchor[anchor] = rule.candidate_windows(text)
+            results.extend(rule.match(text, windows_by_anchor[anchor], self, patterns))
+        return EntityRecognizer.remove_duplicates(results)
+
+# G. PREFILTRO EN UNA PASADA (HYPERSCAN)
+# Hyperscan compila todos los patrones en un único autómata y recorre el prompt
+# una sola vez para saber cuáles pueden coincidir. Sólo esos se corren con `re`,
+# que sigue siendo el que decide las coincidencias: Hyperscan no tiene la misma
+# semántica Unicode (\w, \s, \b, mayúsculas) y no debe dejar pasar nada.
+HYPERSCAN_FLAGS = (
+    hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH if hyperscan else 0
+)
+# Plegados de IGNORECASE de `re` entre no-ASCII y ASCII
+CASEFOLD_SPECIALS = {"\u0130": "i", "\u0131": "i", "\u017f": "s", "\u212a": "k"}
+
+@functools.lru_cache(maxsize=4096)
+def prefilter_char(c: str) -> str:
+    # Reemplaza cada carácter por uno ASCII que cae en las mismas clases de `re`
+    # (o en más), así el prefiltro no depende de las tablas Unicode de Hyperscan
+    if c in CASEFOLD_SPECIALS:
+        return CASEFOLD_SPECIALS[c]
+    if c.isspace():
+        return " "
+    if c.isdecimal():
+        return "0"
+    if c.isalnum() or c == "_":
+        return "a"
+    return "#"
+
+def prefilter_text(text: str) -> str:
+    # Texto y patrones pasan por la misma traducción y quedan en ASCII puro
+    return text.translate({
+        ord(c): prefilter_char(c)
+        for c in set(text)
+        if not c.isascii() or c.isspace()
+    })
+
+def prefilter_expression(regex: str) -> bytes:
+    # Sin \b el patrón sólo puede coincidir en más lugares, nunca en menos
+    return prefilter_text(regex.replace(r"\b", "")).encode("ascii")
+
+class HyperscanRecognizer(CombinedPatternRecognizer):
+    def __init__(self, rules: List[PatternRule]):
+        super().__init__(rules, name="HyperscanRecognizer")
+        self.patterns = [pattern for rule in rules for pattern in rule.patterns]
+        self.database = hyperscan.Database()
+        self.database.compile(
+            expressions=[prefilter_expression(pattern.regex) for pattern in self.patterns],
+            ids=list(range(len(self.patterns))),
+            elements=len(self.patterns),
+            flags=[HYPERSCAN_FLAGS] * len(self.patterns),
+        )
+        # El scratch de Hyperscan no se puede compartir entre escaneos simultáneos
+        self.scan_lock = threading.Lock()
+
+    def candidate_patterns(self, text: str) -> Optional[Set[str]]:
+        data = prefilter_text(text).encode("ascii")
+        fired = set()
+
+        def on_match(pattern_id, start, end, flags, context):
+            fired.add(self.patterns[pattern_id].name)
+
+        with self.scan_lock:
+            self.database.scan(data, match_event_handler=on_match)
+        return fired
+
+# H. MOTOR DE ANÁLISIS
+# Singleton: el modelo de spaCy (~40MB) y el registro de Presidio se construyen
+# una única vez por proceso, lo importe quien lo importe. Se carga en el
+# lifespan de la app, no al importar el módulo.
+custom_rules = [email_rule, phone_rule, bank_rule, dni_rule, money_rule]
+
+def build_custom_recognizers() -> List[EntityRecognizer]:
+    if hyperscan is not None:
+        try:
+            return [HyperscanRecognizer(custom_rules)]
+        except hyperscan.error as e:
+            logger.warning(f"Hyperscan no disponible, se usa re: {str(e)}")
+    return [CombinedPatternRecognizer(custom_rules)]
+
+# Umbral 0: se anonimiza todo lo detectado. Varios recognizers de Presidio
+# puntúan bajo (PHONE_NUMBER 0.4, DATE_TIME/IP menos) y su match de span completo
+# es el que gana el solapamiento; si se descartara, quedaría PII parcial en el prompt.
+SCORE_THRESHOLD = 0.0
+
+@functools.lru_cache(maxsize=1)
+def get_analyzer() -> AnalyzerEngine:
+    provider = NlpEngineProvider(nlp_configuration=nlp_config)
+    nlp_engine = provider.create_engine()
+    spacy_nlp = nlp_engine.nlp["es"]
+    spacy_nlp.select_pipes(disable=[pipe for pipe in UNUSED_SPACY_PIPES if pipe in spacy_nlp.pipe_names])
+    analyzer = AnalyzerEngine(nlp_engine=nlp_engine, supported_languages=["es"])
+    for recognizer in build_custom_recognizers():
+        analyzer.registry.add_recognizer(recognizer)
+    return analyzer
+
+@functools.lru_cache(maxsize=1)
+def get_supported_entities() -> List[str]:
+    return get_analyzer().get_supported_entities(language="es")
+
+@functools.lru_cache(maxsize=1)
+def get_operators() -> Dict[str, OperatorConfig]:
+    # Un reemplazo `<ENTIDAD>` por entidad, armado una sola vez en vez de que
+    # Presidio resuelva el operador por defecto en cada llamada
+    operators = {
+        entity: OperatorConfig("replace", {"new_value": f"<{entity}>"})
+        for entity in get_supported_entities()
+    }
+    operators["DEFAULT"] = OperatorConfig("replace")
+    return operators
+
+# I. PREFILTRO
+# Un recorrido barato del prompt decide qué entidades buscar: sin dígitos no hay
+# DNI/teléfono/cuenta/monto, sin '@' no hay email.
+DIGIT_ENTITIES = {"PHONE_CUSTOM", "BANK_ACCOUNT", "DNI_ARG", "MONEY_AMOUNT"}
+PREFILTER_MAX_LENGTH = 200
+money_hint_regex = re.compile(r"[$€]|pesos|dólares|usd|eur", re.IGNORECASE)
+# URL/dominio (UrlRecognizer), IPv6 y MAC pueden aparecer sin dígitos ni mayúsculas
+address_hint_regex = re.compile(r":|www\.|\w\.[a-z]{2,}|[0-9a-f]{2}-[0-9a-f]{2}", re.IGNORECASE)
+
+def select_entities(prompt: str) -> List[str]:
+    """Entidades que vale la pena buscar en el prompt. Lista vacía = no analizar."""
+    has_digit = any(c.isdigit() for c in prompt)
+    has_at = "@" in prompt
+    has_money = has_digit and money_hint_regex.search(prompt) is not None
+
+    # La NER de spaCy se apoya en las mayúsculas para PERSON/LOC: un prompt corto
+    # sin mayúsculas ni disparadores de ningún recognizer no puede traer PII.
+    if (
+        not has_digit
+        and not has_at
+        and len(prompt) < PREFILTER_MAX_LENGTH
+        and not any(c.isupper() for c in prompt)
+        and address_hint_regex.search(prompt) is None
+    ):
+        return []
+
+    skipped = set()
+    if not has_digit:
+        skipped |= DIGIT_ENTITIES
+    elif not has_money:
+        skipped.add("MONEY_AMOUNT")
+    if not has_at:
+        skipped.add("EMAIL_CUSTOM")
+    return [entity for entity in get_supported_entities() if entity not in skipped]
+
+# J. MICRO-BATCHING
+# spaCy rinde mucho más con nlp.pipe() sobre varios textos que con una llamada
+# por texto. Los analyze() que llegan dentro de una ventana corta se agrupan:
+# un solo process_batch() de spaCy y después los recognizers de cada prompt.
+class PromptTooLongError(ValueError):
+    pass
+
+class AnalyzerBatcher:
+    def __init__(self, analyzer: AnalyzerEngine, max_batch: int = 16, max_wait: float = 0.005):
+        self.analyzer = analyzer
+        # Más largo que esto spaCy lo rechaza (E088): se corta antes de encolarlo
+        self.max_length = analyzer.nlp_engine.nlp["es"].max_length
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
 
+    def start(self):
+        self.task = asyncio.create_task(self.run())
 
-# --- 3. CLIENTE OPENAI ---
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+
+    async def analyze(self, text: str, entities: List[str]) -> List[RecognizerResult]:
+        if len(text) > self.max_length:
+            raise PromptTooLongError(f"El prompt supera los {self.max_length} caracteres")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, entities, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Ventana corta para que se sumen los requests que llegan casi juntos
+            await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            items = [(text, entities) for text, entities, _ in batch]
+            try:
+                batch_results = await asyncio.to_thread(self.analyze_batch, items)
+            except Exception as e:
+                # Un prompt roto no tiene que tirar a todo el lote: se reintenta
+                # cada uno por separado y el error queda sólo en el que falla
+                logger.warning(f"Falló el lote de {len(batch)} prompts, se analizan uno por uno: {e}")
+                await self.run_one_by_one(batch)
+                continue
+            for (_, _, future), results in zip(batch, batch_results):
+                # done() cubre los requests cancelados (cliente que se desconectó)
+                if not future.done():
+                    future.set_result(results)
+
+    async def run_one_by_one(self, batch):
+        for text, entities, future in batch:
+            if future.done():
+                continue
+            try:
+                results = await asyncio.to_thread(self.analyze_batch, [(text, entities)])
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(results[0])
+
+    def analyze_batch(self, items: List[Tuple[str, List[str]]]) -> List[List[RecognizerResult]]:
+        texts = [text for text, _ in items]
+        artifacts = self.analyzer.nlp_engine.process_batch(texts, language="es", batch_size=len(texts))
+        return [
+            self.analyzer.analyze(
+                text=text,
+                language="es",
+                entities=entities,
+                nlp_artifacts=nlp_artifacts,
+                score_threshold=SCORE_THRESHOLD,
+                return_decision_process=False,
+            )
+            for (text, entities), (_, nlp_artifacts) in zip(items, artifacts)
+        ]
+
+
+# --- 3. CACHÉ DE RESPUESTAS ---
+# Las claves son prompts ya anonimizados: no se guarda ningún dato sensible.
+# Nivel 1: coincidencia exacta (dict). Nivel 2: similitud semántica (FAISS).
+CACHE_MAX_ENTRIES = 10000
+CACHE_SIMILARITY_THRESHOLD = 0.95
+
+# Las funciones de caché corren en hilos (asyncio.to_thread): FAISS no admite
+# add() concurrente con search(), así que todo acceso al índice va con lock.
+cache_lock = threading.Lock()
+prompt_cache: Dict[str, str] = {}
+semantic_responses: List[str] = []
+
+@functools.lru_cache(maxsize=1)
+def get_embedder() -> SentenceTransformer:
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+@functools.lru_cache(maxsize=1)
+def get_semantic_index() -> faiss.IndexFlatIP:
+    return faiss.IndexFlatIP(get_embedder().get_sentence_embedding_dimension())
+
+def embed_prompt(prompt: str) -> np.ndarray:
+    # Vectores normalizados: el producto interno equivale a la similitud coseno
+    return get_embedder().encode([prompt], normalize_embeddings=True).astype("float32")
+
+def lookup_cached_response(prompt_seguro: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    cached = prompt_cache.get(prompt_seguro)
+    if cached is not None:
+        return cached, None
+
+    embedding = embed_prompt(prompt_seguro)
+    semantic_index = get_semantic_index()
+    with cache_lock:
+        if semantic_index.ntotal > 0:
+            scores, ids = semantic_index.search(embedding, 1)
+            if scores[0][0] >= CACHE_SIMILARITY_THRESHOLD:
+                return semantic_responses[ids[0][0]], embedding
+    return None, embedding
+
+def store_cached_response(prompt_seguro: str, ai_response: str, embedding: Optional[np.ndarray] = None):
+    # Al llegar al límite dejamos de cachear en lugar de crecer sin control
+    if len(prompt_cache) >= CACHE_MAX_ENTRIES:
+        return
+    if embedding is None:
+        embedding = embed_prompt(prompt_seguro)
+    with cache_lock:
+        prompt_cache[prompt_seguro] = ai_response
+        get_semantic_index().add(embedding)
+        semantic_responses.append(ai_response)
+
+# Con `gunicorn --preload` el módulo se importa en el proceso padre antes del
+# fork: cargar los modelos acá hace que los workers los compartan (copy-on-write)
+# en vez de cargar una copia cada uno en el lifespan. Sin OPENAI_API_KEY la
+# caché de respuestas no se usa: el embedder y el índice no se cargan.
+if os.environ.get("PRELOAD_MODELS") == "1":
+    get_analyzer()
+    if os.environ.get("OPENAI_API_KEY"):
+        get_semantic_index()
+
+
+# --- 4. CLIENTE OPENAI ---
 api_key = os.environ.get("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# Pool propio: más conexiones keep-alive y HTTP/2 para no pagar un handshake TLS
+# nuevo con api.openai.com en cada ráfaga de requests.
+# Timeouts iguales a los del SDK (600 s de lectura): un borrador largo tarda.
+# Se crea en el lifespan: un cliente cerrado no se puede reabrir en otro arranque.
+def build_openai_client() -> AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    )
+    return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+OPENAI_MODEL = "gpt-3.5-turbo"
+SYSTEM_PROMPT = "Eres un asistente legal útil. El usuario te enviará textos con datos sensibles ocultos (ej: <DNI_ARG>, <MONEY_AMOUNT>). Redacta o responde manteniendo esos placeholders en su lugar para que luego puedan ser rellenados."
 
-# --- 4. API FASTAPI ---
-app = FastAPI(title="Privacy Firewall API", version="2.1.0")
+def build_messages(prompt_seguro: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt_seguro}
+    ]
+
+# --- 5. API FASTAPI ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Carga de modelos fuera del import y en un hilo, para no frenar el arranque
+    analyzer = await asyncio.to_thread(get_analyzer)
+    if api_key:
+        await asyncio.to_thread(get_semantic_index)
+    # Warmup: la primera pasada por spaCy inicializa sus cachés internas
+    await asyncio.to_thread(analyzer.analyze, text="hola mundo 12345678", language="es")
+    app.state.batcher = AnalyzerBatcher(analyzer)
+    app.state.openai_client = build_openai_client()
+    app.state.batcher.start()
+    yield
+    await app.state.batcher.stop()
+    await app.state.openai_client.close()
+
+# orjson serializa bastante más rápido que el json de la stdlib
+app = FastAPI(
+    title="Privacy Firewall API",
+    version="2.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -79,43 +554,145 @@ class SecureChatResponse(BaseModel):
     ai_response: str
     safety_report: SafetyReport
 
+# LRU de sanitización: reintentos del mismo prompt no vuelven a pasar por spaCy
+# ni por los regex. Sólo se toca desde el event loop, así que no necesita lock.
+# La clave es el SHA-256 del prompt: el prompt original (con la PII) no queda en memoria.
+SANITIZE_CACHE_MAX_ENTRIES = 4096
+sanitize_cache: "OrderedDict[bytes, Tuple[str, List[str]]]" = OrderedDict()
+
+def anonymize_results(prompt: str, results: List[RecognizerResult]) -> Tuple[str, List[str]]:
+    # Anonimizado y tipos detectados salen de la misma pasada en el hilo de
+    # trabajo: el event loop no recorre los resultados. Las etiquetas son un
+    # vocabulario chico y se internan para que todas las respuestas las compartan.
+    anonymized_result = anonymizer.anonymize(text=prompt, analyzer_results=results, operators=get_operators())
+    return anonymized_result.text, [sys.intern(entity) for entity in {res.entity_type for res in results}]
+
+async def sanitize_prompt(batcher: AnalyzerBatcher, prompt: str) -> Tuple[str, List[str]]:
+    """Devuelve el prompt anonimizado y los tipos de dato sensible detectados."""
+    cache_key = hashlib.sha256(prompt.encode("utf-8", "surrogatepass")).digest()
+    cached = sanitize_cache.get(cache_key)
+    if cached is not None:
+        sanitize_cache.move_to_end(cache_key)
+        return cached
+
+    # A. ANALIZAR (en lote y en un hilo, para no bloquear el loop)
+    entities = select_entities(prompt)
+    if entities:
+        results = await batcher.analyze(prompt, entities)
+    else:
+        results = []
+
+    # B. ANONIMIZAR
+    if results:
+        prompt_seguro, detected_types = await asyncio.to_thread(anonymize_results, prompt, results)
+    else:
+        prompt_seguro, detected_types = prompt, []
+
+    sanitize_cache[cache_key] = (prompt_seguro, detected_types)
+    if len(sanitize_cache) > SANITIZE_CACHE_MAX_ENTRIES:
+        sanitize_cache.popitem(last=False)
+    return prompt_seguro, detected_types
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    message = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
 @app.get("/")
 def health_check():
     return {"status": "online", "mode": "OpenAI Connected" if api_key else "Simulation Mode"}
 
 @app.post("/chat/secure", response_model=SecureChatResponse)
-async def secure_chat(request: SecureChatRequest):
+async def secure_chat(request: SecureChatRequest, http_request: Request):
+    batcher = http_request.app.state.batcher
+    openai_client = http_request.app.state.openai_client
     try:
-        # A. ANALIZAR
-        results = analyzer.analyze(text=request.prompt, language='es')
-        
-        # B. ANONIMIZAR
-        anonymized_result = anonymizer.anonymize(text=request.prompt, analyzer_results=results)
-        prompt_seguro = anonymized_result.text
-        
-        detected_types = list(set([res.entity_type for res in results]))
+        prompt_seguro, detected_types = await sanitize_prompt(batcher, request.prompt)
 
         # C. LLAMAR A OPENAI
         if not api_key:
             ai_response = f"[SIMULACIÓN] Prompt seguro: {prompt_seguro}"
         else:
-            completion = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "Eres un asistente legal útil. El usuario te enviará textos con datos sensibles ocultos (ej: <DNI_ARG>, <MONEY_AMOUNT>). Redacta o responde manteniendo esos placeholders en su lugar para que luego puedan ser rellenados."},
-                    {"role": "user", "content": prompt_seguro}
-                ]
-            )
-            ai_response = completion.choices[0].message.content
+            ai_response, embedding = await asyncio.to_thread(lookup_cached_response, prompt_seguro)
+            if ai_response is None:
+                completion = await openai_client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=build_messages(prompt_seguro)
+                )
+                choice = completion.choices[0]
+                ai_response = choice.message.content or ""
+                # Sólo se cachean respuestas completas: una vacía o cortada
+                # (length, content_filter) se serviría para siempre
+                if ai_response and choice.finish_reason == "stop":
+                    await asyncio.to_thread(store_cached_response, prompt_seguro, ai_response, embedding)
 
-        return SecureChatResponse(
+        # model_construct: los datos los arma el servidor, no hace falta validarlos.
+        # FastAPI no revalida instancias del response_model y las serializa
+        # directo a JSON con pydantic-core.
+        return SecureChatResponse.model_construct(
             ai_response=ai_response,
-            safety_report=SafetyReport(
+            safety_report=SafetyReport.model_construct(
                 detected_items=detected_types,
                 sanitized_prompt=prompt_seguro
             )
         )
 
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/chat/secure/stream")
+async def secure_chat_stream(request: SecureChatRequest, http_request: Request):
+    """Igual que /chat/secure pero por Server-Sent Events.
+
+    Primero llega el evento `safety_report`, después la respuesta en eventos
+    `{"delta": ...}` a medida que OpenAI la genera, y al final `done` (o `error`).
+    """
+    batcher = http_request.app.state.batcher
+    openai_client = http_request.app.state.openai_client
+    try:
+        prompt_seguro, detected_types = await sanitize_prompt(batcher, request.prompt)
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def event_stream():
+        report = SafetyReport.model_construct(detected_items=detected_types, sanitized_prompt=prompt_seguro)
+        yield sse_event(report.model_dump(), event="safety_report")
+        try:
+            if not api_key:
+                yield sse_event({"delta": f"[SIMULACIÓN] Prompt seguro: {prompt_seguro}"})
+            else:
+                ai_response, embedding = await asyncio.to_thread(lookup_cached_response, prompt_seguro)
+                if ai_response is not None:
+                    yield sse_event({"delta": ai_response})
+                else:
+                    stream = await openai_client.chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=build_messages(prompt_seguro),
+                        stream=True
+                    )
+                    parts = []
+                    finish_reason = None
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        choice = chunk.choices[0]
+                        finish_reason = choice.finish_reason or finish_reason
+                        delta = choice.delta.content
+                        if delta:
+                            parts.append(delta)
+                            yield sse_event({"delta": delta})
+                    # Igual que en /chat/secure: sólo respuestas completas y no vacías
+                    if parts and finish_reason == "stop":
+                        await asyncio.to_thread(store_cached_response, prompt_seguro, "".join(parts), embedding)
+            yield sse_event({}, event="done")
+        except Exception as e:
+            # Los headers ya salieron: el error se informa como evento del stream
+            logger.error(f"Error: {str(e)}")
+            yield sse_event({"detail": str(e)}, event="error")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")